@@ -8,7 +8,7 @@ from charms.tls_certificates_interface.v4.tls_certificates import (
 )
 import logging
 import ops
-from typing import Optional
+from typing import Dict, Optional
 
 CERTS_DIR_PATH = "/etc/headscale"
 PRIVATE_KEY_NAME = "headscale.key"
@@ -19,17 +19,17 @@ logger = logging.getLogger(__name__)
 class CertHandler:
     def __init__(self, charm: ops.CharmBase, name: str):
         self.charm = charm
+        self._request_attrs = CertificateRequestAttributes(common_name=name)
         self.certificates = TLSCertificatesRequiresV4(
                 charm=charm,
                 relationship_name="certificates",
-                certificate_requests=[CertificateRequestAttributes(common_name=name)],
+                certificate_requests=[self._request_attrs],
                 mode=Mode.UNIT,
             )
         self.container = charm.unit.get_container("headscale")
         self.name = name
-
-    def _get_certificate_request_attributes(self) -> CertificateRequestAttributes:
-        return CertificateRequestAttributes(common_name=self.name)
+        # whether the last configure_certs() pushed a new certificate or key
+        self.updated = False
 
     def configure_certs(self) -> bool:
         if not self.container.can_connect():
@@ -38,12 +38,15 @@ class CertHandler:
         if not self._relation_created("certificates"):
             logger.info("Certs say: No certificate relation")
             return False
-        if not self._certificate_is_available():
+        provider_certificate, private_key = self.certificates.get_assigned_certificate(
+            certificate_request=self._request_attrs
+        )
+        if not provider_certificate or not private_key:
             logger.info("Certs say: cert isn't available")
             return False
 
         logger.info("Certs ready")
-        certificate_update_required = self._check_and_update_certificate()
+        self.updated = self._check_and_update_certificate(provider_certificate, private_key)
         return True
 
     def remove_certs(self):
@@ -53,74 +56,69 @@ class CertHandler:
     def _relation_created(self, relation_name: str) -> bool:
         return bool(self.charm.model.relations.get(relation_name))
 
-    def _certificate_is_available(self) -> bool:
-        cert, key = self.certificates.get_assigned_certificate(
-            certificate_request=self._get_certificate_request_attributes()
-        )
-        return bool(cert and key)
-
-    def _check_and_update_certificate(self) -> bool:
+    def _check_and_update_certificate(
+        self, provider_certificate: ProviderCertificate, private_key: PrivateKey
+    ) -> bool:
         """Check if the certificate or private key needs an update and perform the update.
 
-        This method retrieves the currently assigned certificate and private key associated with
-        the charm's TLS relation. It checks whether the certificate or private key has changed
-        or needs to be updated. If an update is necessary, the new certificate or private key is
-        stored.
+        The stored certificate and private key are looked up with a single listing of the
+        certificate directory and pulled from the workload only if they exist. If either
+        differs from the assigned one, the new one is stored.
 
         Returns:
             bool: True if either the certificate or the private key was updated, False otherwise.
         """
-        provider_certificate, private_key = self.certificates.get_assigned_certificate(
-            certificate_request=self._get_certificate_request_attributes()
-        )
-        if not provider_certificate or not private_key:
-            logger.debug("Certificate or private key is not available")
-            return False
-        if certificate_update_required := self._is_certificate_update_required(provider_certificate.chain):
-            self._store_certificate(certificate=provider_certificate)
-        if private_key_update_required := self._is_private_key_update_required(private_key):
+        stored = self._stored_files()
+        stored_certificate = self._read_stored_file(stored.get(CERTIFICATE_NAME))
+        stored_private_key = self._read_stored_file(stored.get(PRIVATE_KEY_NAME))
+        chain = self._concat_chain(provider_certificate.chain)
+        if certificate_update_required := self._is_certificate_update_required(
+            stored_certificate, chain
+        ):
+            self._store_certificate(chain=chain)
+        if private_key_update_required := self._is_private_key_update_required(
+            stored_private_key, private_key
+        ):
             self._store_private_key(private_key=private_key)
         return certificate_update_required or private_key_update_required
 
-    def _is_certificate_update_required(self, certs: list[Certificate]) -> bool:
-        return self._get_existing_certificate() != self._concat_chain(certs)
-
-    def _is_private_key_update_required(self, private_key: PrivateKey) -> bool:
-        return self._get_existing_private_key() != private_key
-
-    def _get_existing_certificate(self) -> Optional[str]:
-        return self._get_stored_certificate() if self._certificate_is_stored() else None
-
-    def _get_existing_private_key(self) -> Optional[PrivateKey]:
-        return self._get_stored_private_key() if self._private_key_is_stored() else None
-
-    def _certificate_is_stored(self) -> bool:
-        return self.container.exists(path=f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}")
-
-    def _private_key_is_stored(self) -> bool:
-        return self.container.exists(path=f"{CERTS_DIR_PATH}/{PRIVATE_KEY_NAME}")
-
-    def _get_stored_certificate(self) -> str:
-        cert_string = str(self.container.pull(path=f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}").read())
-        return cert_string
-
-    def _get_stored_private_key(self) -> PrivateKey:
-        key_string = str(self.container.pull(path=f"{CERTS_DIR_PATH}/{PRIVATE_KEY_NAME}").read())
-        return PrivateKey.from_string(key_string)
-
-    def _store_certificate(self, certificate: ProviderCertificate) -> None:
-        """Store certificate in workload."""
+    @staticmethod
+    def _is_certificate_update_required(stored: Optional[str], chain: str) -> bool:
+        return stored != chain
 
-        self.container.push(path=f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}", source=self._concat_chain(certificate.chain))
+    @staticmethod
+    def _is_private_key_update_required(stored: Optional[str], private_key: PrivateKey) -> bool:
+        return stored is None or PrivateKey.from_string(stored) != private_key
+
+    def _stored_files(self) -> Dict[str, ops.pebble.FileInfo]:
+        """List the certificate directory in the workload, keyed by file name."""
+        try:
+            return {f.name: f for f in self.container.list_files(CERTS_DIR_PATH)}
+        except ops.pebble.APIError as e:
+            if e.code == 404:
+                return {}
+            raise
+
+    def _read_stored_file(self, info: Optional[ops.pebble.FileInfo]) -> Optional[str]:
+        """Read a listed file from the workload, None if it wasn't listed."""
+        if info is None:
+            return None
+        with self.container.pull(path=info.path) as f:
+            return f.read()
+
+    def _store_certificate(self, chain: str) -> None:
+        """Store certificate chain in workload."""
+
+        self.container.push(path=f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}", source=chain)
         logger.info("Pushed certificate pushed to workload")
 
     @staticmethod
     def _concat_chain(certs: list[Certificate]) -> str:
-        return "\n".join([str(c) for c in certs])
+        return "\n".join(map(str, certs))
 
     def _remove_certificate(self) -> None:
         """Remove certificate in workload."""
-        self.container.exec(["rm", f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}" ])
+        self._remove_stored_file(f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}")
 
     def _store_private_key(self, private_key: PrivateKey) -> None:
         """Store private key in workload."""
@@ -132,4 +130,10 @@ class CertHandler:
 
     def _remove_private_key(self) -> None:
         """Remove private key in workload."""
-        self.container.exec(["rm", f"{CERTS_DIR_PATH}/{PRIVATE_KEY_NAME}"])
+        self._remove_stored_file(f"{CERTS_DIR_PATH}/{PRIVATE_KEY_NAME}")
+
+    def _remove_stored_file(self, path: str) -> None:
+        try:
+            self.container.remove_path(path, recursive=False)
+        except ops.pebble.PathError as e:
+            logger.debug(f"Couldn't remove {path}: {e}")
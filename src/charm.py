@@ -4,6 +4,7 @@
 
 """Charm the application."""
 
+import functools
 import logging
 import os
 import time
@@ -20,6 +21,10 @@ from certificates import CertHandler
 
 logger = logging.getLogger(__name__)
 
+# Static parts of the traefik router, plain and with TLS passed through to headscale
+_HTTP_ROUTER = {"entryPoints": ["web"]}
+_HTTPS_ROUTER = {"entryPoints": ["websecure"], "tls": {"passthrough": True}}
+
 class HeadscaleCharm(ops.CharmBase):
     """Charm the application."""
 
@@ -27,9 +32,12 @@ class HeadscaleCharm(ops.CharmBase):
         super().__init__(framework)
         self.container = self.unit.get_container("headscale")
         self.headscale = Headscale(self.container, self.load_config(HeadscaleConfig))
-        self.pebble_service_name = 'headscale-server'
         self.ingress = TraefikRouteRequirer(self, self.model.get_relation("traefik-route"), "traefik-route", raw=True)
-        self.headscale.set_name(self._external_name())
+        self._router_name = f"juju-{self.model.name}-{self.model.app.name}-router"
+        self._service_name = f"juju-{self.model.name}-{self.model.app.name}-service"
+        external_name = self._external_name()
+        self.headscale.set_name(external_name)
+        self._reconciled = False
 
         self.metrics_endpoint = MetricsEndpointProvider(self,jobs=[
             {
@@ -44,7 +52,7 @@ class HeadscaleCharm(ops.CharmBase):
             relation_name="logging"  # optional, defaults to `logging`
         )
 
-        self.certs = CertHandler(self, self._external_name())
+        self.certs = CertHandler(self, external_name)
         framework.observe(self.certs.certificates.on.certificate_available, self._on_certs_available)
         framework.observe(self.on["certificates"].relation_departed, self._on_certs_removed)
         framework.observe(self.on["certificates"].relation_changed, self._on_certs_available)
@@ -66,11 +74,17 @@ class HeadscaleCharm(ops.CharmBase):
         self._configure_and_restart()
 
     def _configure_and_restart(self):
+        # A certificates relation-changed emits both certificate_available and relation_changed
+        # in the same dispatch. Everything is read fresh here, so reconciling once is enough.
+        if self._reconciled:
+            logger.debug("Already reconciled in this hook")
+            return
+        self._reconciled = True
         self.headscale.set_name(self._external_name())
         if self.certs.configure_certs():
             self.headscale.tls = True
         self._setup_ingress()
-        self.headscale.render_config()
+        self.headscale.render_config(force_restart=self.certs.updated)
         self._update_layer_and_restart()
 
     def _on_certs_removed(self, _: ops.EventBase):
@@ -87,7 +101,8 @@ class HeadscaleCharm(ops.CharmBase):
 
     def _on_ingress_ready(self, event: TraefikRouteProviderReadyEvent):
         logger.debug(f"Running event: {event}")
-        self._setup_ingress()
+        # the traefik lib has just stored the external host, so the name and certs may change
+        self._configure_and_restart()
 
     def _on_create_authkey(self, event: ops.ActionEvent):
         params = event.load_params(CreateAuthkeyAction, errors="fail")
@@ -145,28 +160,22 @@ class HeadscaleCharm(ops.CharmBase):
 
     def _external_name(self) -> str:
         if self.ingress.is_ready() and self.ingress.external_host:
-            return self.headscale.config.name+"."+self.ingress.external_host
+            return f"{self.headscale.config.name}.{self.ingress.external_host}"
         return self.headscale.config.name
 
     def _ingress_config(self) -> dict:
-        router_name = f"juju-{self.model.name}-{self.model.app.name}-router"
-        service_name = f"juju-{self.model.name}-{self.model.app.name}-service"
+        router_name, service_name = self._router_name, self._service_name
+        if self.headscale.tls:
+            router, port = _HTTPS_ROUTER, 443
+        else:
+            router, port = _HTTP_ROUTER, 80
         routers = {
             router_name: {
-                "entryPoints": ["web"],
+                **router,
                 "service": service_name,
-                "rule": f"HostSNI(`{self._external_name()}`)",
+                "rule": f"HostSNI(`{self.headscale.name}`)",
             },
         }
-        if self.headscale.config.tls:
-            routers[router_name] |= {
-                "tls": { "passthrough": True },
-                "entryPoints": ["websecure"],
-            }
-            port = 443
-        else:
-            routers[router_name] |= {"entryPoints": ["web"]}
-            port = 80
 
         rel = self.model.get_relation("traefik-route")
         ip = self.model.get_binding(rel).network.bind_address
@@ -185,24 +194,41 @@ class HeadscaleCharm(ops.CharmBase):
             return
         if self.ingress.is_ready():
             self.ingress.submit_to_traefik(config=self._ingress_config())
-            self.headscale.render_config()
 
     def _update_layer_and_restart(self) -> None:
         self.unit.status = ops.MaintenanceStatus('Assembling Pebble layers')
         try:
-            self.container.add_layer('base', self._get_pebble_layer(), combine=True)
-            logger.info("Added updated layer base to Pebble plan")
+            layer = self._pebble_layer
+            if self._layer_is_planned(layer) and self._layer_is_running(layer):
+                logger.info("Pebble plan is up to date and running, skipping replan")
+            else:
+                self.container.add_layer('base', layer, combine=True)
+                logger.info("Added updated layer base to Pebble plan")
 
-            self.container.replan()
-            logger.info(f"Replanned with '{self.pebble_service_name}' service")
+                self.container.replan()
+                logger.info(f"Replanned with '{self.headscale.pebble_service_name}' service")
 
             self.unit.status = ops.ActiveStatus()
         except (ops.pebble.APIError, ops.pebble.ConnectionError) as e:
             logger.info('Unable to connect to Pebble: %s', e)
             self.unit.status = ops.MaintenanceStatus('Waiting for Pebble in workload container')
 
-    def _get_pebble_layer(self) -> ops.pebble.Layer:
-        """A Pebble layer for the FastAPI demo services."""
+    def _layer_is_planned(self, layer: ops.pebble.Layer) -> bool:
+        """Check whether all services of the layer are already in the Pebble plan as-is."""
+        planned = self.container.get_plan().services
+        return all(
+            name in planned and planned[name] == service
+            for name, service in layer.services.items()
+        )
+
+    def _layer_is_running(self, layer: ops.pebble.Layer) -> bool:
+        """Check whether all services of the layer are running, as replan would start them."""
+        running = self.container.get_services(*layer.services)
+        return all(name in running and running[name].is_running() for name in layer.services)
+
+    @functools.cached_property
+    def _pebble_layer(self) -> ops.pebble.Layer:
+        """The Pebble layer for headscale and its exporter, built once per hook."""
         pebble_layer: ops.pebble.LayerDict = {
             'summary': 'Headscale service',
             'description': 'Layer to start headscale',
@@ -244,7 +270,7 @@ class HeadscaleCharm(ops.CharmBase):
         self.unit.status = ops.MaintenanceStatus("starting workload")
         if self.certs.configure_certs():
             self.headscale.tls = True
-        self.headscale.render_config()
+        self.headscale.render_config(force_restart=self.certs.updated)
         self._update_layer_and_restart()
 
         self.wait_for_ready()
@@ -256,25 +282,30 @@ class HeadscaleCharm(ops.CharmBase):
 
     def is_ready(self) -> bool:
         """Check whether the workload is ready to use."""
-        # We'll first check whether all Pebble services are running.
-        for name, service_info in self.container.get_services().items():
-            if not service_info.is_running():
-                logger.info("the workload is not ready (service '%s' is not running)", name)
-                return False
+        # We'll first check whether all Pebble services are running,
+        # stopping at the first that isn't.
+        services = self.container.get_services().items()
+        stopped = next((name for name, info in services if not info.is_running()), None)
+        if stopped is not None:
+            logger.info("the workload is not ready (service '%s' is not running)", stopped)
+            return False
         # The Pebble services are running, but the workload might not be ready to use.
         # So we'll check whether all Pebble 'ready' checks are passing.
         checks = self.container.get_checks(level=ops.pebble.CheckLevel.READY)
-        for check_info in checks.values():
-            if check_info.status != ops.pebble.CheckStatus.UP:
-                return False
-        return True
+        return all(info.status == ops.pebble.CheckStatus.UP for info in checks.values())
 
     def wait_for_ready(self) -> None:
-        """Wait for the workload to be ready to use."""
-        for _ in range(10):
+        """Wait for the workload to be ready to use.
+
+        Polls with an exponential backoff, so a quickly starting workload doesn't hold up the hook.
+        """
+        deadline = time.monotonic() + 30
+        delay = 0.025
+        while time.monotonic() < deadline:
             if self.is_ready():
                 return
-            time.sleep(1)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
         logger.error("the workload was not ready within the expected time")
         raise RuntimeError("workload is not ready")
         # The runtime error is for you (the charm author) to see, not for the user of the charm.
@@ -6,27 +6,78 @@
 The intention is that this module could be used outside the context of a charm.
 """
 import datetime
+import json
 import logging
 import dataclasses
+import shutil
 from pathlib import Path
 
-from pydantic import BaseModel
 import ops
 import yaml
-from tempfile import TemporaryDirectory
-from tarfile import TarFile
+from tarfile import TarFile, TarInfo
 from typing import Any, Dict, Optional, List#, cast
 
 from certificates import (CERTIFICATE_NAME, CERTS_DIR_PATH, PRIVATE_KEY_NAME)
 
+try:
+    from yaml import CSafeDumper as _Dumper
+    from yaml import CSafeLoader as _Loader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeDumper as _Dumper
+    from yaml import SafeLoader as _Loader
+
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH=Path("/etc/headscale/config.yaml")
 POLICY_PATH=Path("/etc/headscale/policy.hujson")
 SQLITE_PATH=Path("/var/lib/headscale/db.sqlite")
 NOISE_KEY=Path("/var/lib/headscale/noise_private.key")
 
 BACKUP_PATH=Path("/tmp/backup/")
 
+_TLS_CERT_PATH = f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}"
+_TLS_KEY_PATH = f"{CERTS_DIR_PATH}/{PRIVATE_KEY_NAME}"
+_LISTEN_HTTPS = "0.0.0.0:443"
+_LISTEN_HTTP = "0.0.0.0:80"
+
+_LOG_LEVEL_NAMES = ("info", "debug", "critical", "warning")
+_LOG_LEVELS = frozenset(_LOG_LEVEL_NAMES)
+_LOG_LEVELS_ERR = ", ".join(_LOG_LEVEL_NAMES)
+_DEFAULT_OIDC_EXPIRY = "1d"
+_DEFAULT_OIDC_SCOPE = ("openid", "email", "profile")
+
+_YAML_OPTS: Dict[str, Any] = {"Dumper": _Dumper, "sort_keys": False, "default_flow_style": False}
+
+# Settings that don't depend on the charm config, kept as YAML so that only the dynamic part of
+# config.yaml has to go through the emitter. Block mappings concatenate, so this is just prepended.
+_STATIC_YAML = f"""\
+metrics_listen_addr: 0.0.0.0:9090
+noise:
+  private_key_path: {NOISE_KEY}
+prefixes:
+  v4: 100.64.0.0/10
+  v6: fd7a:115c:a1e0::/48
+  allocation: sequential
+derp:
+  server:
+    enabled: false
+  urls:
+  - https://controlplane.tailscale.com/derpmap/default
+  auto_update_enabled: true
+  update_frequency: 24h
+disable_check_updates: false
+ephemeral_node_inactivity_timeout: 30m
+database:
+  type: sqlite
+  debug: 'false'
+  sqlite:
+    path: {SQLITE_PATH}
+    write_ahead_log: true
+    wal_autocheckpoint: 1000
+unix_socket: /var/run/headscale/headscale.sock
+unix_socket_permission: '0770'
+"""
+
 
 @dataclasses.dataclass(frozen=True, kw_only=True)
 class HeadscaleConfig:
@@ -43,43 +94,6 @@ class HeadscaleConfig:
     oidc_scope: Optional[List[str]] = None
     oidc_groups: Optional[List[str]] = None
 
-    @staticmethod
-    def static_config() -> Dict[str, Any]:
-        return {
-            "metrics_listen_addr": "0.0.0.0:9090",
-            "noise": {
-                "private_key_path": str(NOISE_KEY)
-            },
-            "prefixes": {
-                "v4": "100.64.0.0/10",
-                "v6": "fd7a:115c:a1e0::/48",
-                "allocation": "sequential",
-            },
-            "derp": {
-                "server": {
-                    "enabled": False
-                },
-                "urls": [
-                    "https://controlplane.tailscale.com/derpmap/default"
-                ],
-                "auto_update_enabled": True,
-                "update_frequency": "24h"
-            },
-            "disable_check_updates": False,
-            "ephemeral_node_inactivity_timeout": "30m",
-            "database": {
-                "type": "sqlite",
-                "debug": "false",
-                "sqlite": {
-                    "path": str(SQLITE_PATH),
-                    "write_ahead_log": True,
-                    "wal_autocheckpoint": 1000
-                },
-            },
-            "unix_socket": "/var/run/headscale/headscale.sock",
-            "unix_socket_permission": "0770"
-        }
-
     def oidc(self) -> Dict:
         if not self.oidc_issuer:
             return {}
@@ -88,8 +102,8 @@ class HeadscaleConfig:
             "issuer": self.oidc_issuer,
             "client_id": self.oidc_client_id,
             "client_secret": secret,
-            "expiry": self.oidc_expiry or "1d",
-            "scope": self.oidc_scope or ["openid", "email", "profile"],
+            "expiry": self.oidc_expiry or _DEFAULT_OIDC_EXPIRY,
+            "scope": self.oidc_scope or _DEFAULT_OIDC_SCOPE,
             "only_start_if_oidc_is_available": True
         }
         if self.oidc_groups:
@@ -106,14 +120,14 @@ class HeadscaleConfig:
         logger.info(f"generating TLS config. Enabled: {enabled}, Name: {name}")
         if enabled:
             return {
-                "tls_cert_path": f"{CERTS_DIR_PATH}/{CERTIFICATE_NAME}" if enabled else "",
-                "tls_key_path": f"{CERTS_DIR_PATH}/{PRIVATE_KEY_NAME}" if enabled else "",
+                "tls_cert_path": _TLS_CERT_PATH,
+                "tls_key_path": _TLS_KEY_PATH,
                 "server_url": f"https://{name}:443",
-                "listen_addr": f"0.0.0.0:443",
+                "listen_addr": _LISTEN_HTTPS,
             }
         return {
             "server_url": f"http://{name}:80",
-            "listen_addr": f"0.0.0.0:80"
+            "listen_addr": _LISTEN_HTTP,
         }
 
     def log(self) -> Dict[str, Dict[str, str]]:
@@ -128,23 +142,23 @@ class HeadscaleConfig:
 
     def __post_init__(self):
         """Validate the configuration."""
-        
-        levels = ["info", "debug", "critical", "warning"]
-        if self.log_level not in levels:
-            raise ValueError(f"Invalid log-level: '{self.log_level}' not in {", ".join(levels)}.")
-
-        oidc_configs = [
-            self.oidc_issuer, self.oidc_client_id, self.oidc_secret,
-            self.oidc_expiry, self.oidc_scope, self.oidc_groups
-        ]
-        if any(oidc_configs):
-            if not all([self.oidc_issuer, self.oidc_secret, self.oidc_client_id]):
-                logging.error(f"{self.oidc_issuer}, {self.oidc_secret}, {self.oidc_client_id}")
+        if self.log_level not in _LOG_LEVELS:
+            raise ValueError(f"Invalid log-level: '{self.log_level}' not in {_LOG_LEVELS_ERR}.")
+
+        if (
+            self.oidc_issuer or self.oidc_client_id or self.oidc_secret
+            or self.oidc_expiry or self.oidc_scope or self.oidc_groups
+        ):
+            if not (self.oidc_issuer and self.oidc_secret and self.oidc_client_id):
+                logger.error(f"{self.oidc_issuer}, {self.oidc_secret}, {self.oidc_client_id}")
                 raise ValueError(f"Minimum OIDC Settings: issuer, secret, client_id")
             if self.oidc_groups and not self.oidc_scope:
                 logger.warning("OIDC groups are set, but no scope.")
 
-class CmdResult(BaseModel):
+@dataclasses.dataclass(frozen=True)
+class CmdResult:
+    """Result of a command run in the workload container."""
+
     stderr: str
     stdout: Dict | List
     exit_code: int
@@ -179,24 +193,42 @@ class Headscale:
         self.name = name
 
     def _generate_config(self) -> Dict[str, Any]:
-        config_dict = self.config.static_config()
-        config_dict["dns"] = self.config.dns()
-        config_dict["policy"] = self.config.get_policy()
-        # merge operator for dict: Didn't know that one!
-        config_dict |= self.config.oidc()
-        config_dict |= self.config.tls(self.tls, self.name)
-        config_dict |= self.config.log()
-
-        return config_dict
+        """Build the part of config.yaml that depends on the charm config and state."""
+        return {
+            "dns": self.config.dns(),
+            "policy": self.config.get_policy(),
+            **self.config.oidc(),
+            **self.config.tls(self.tls, self.name),
+            **self.config.log(),
+        }
 
-    def render_config(self):
+    def render_config(self, force_restart: bool = False):
+        """Push the config and policy, restarting headscale only if either of them changed."""
         try:
-            self._check_policy()
+            policy_changed = self._check_policy()
         except ValueError as e:
             raise e
 
-        self.container.push("/etc/headscale/config.yaml", yaml.dump(self._generate_config()), make_dirs=True)
-        self.container.restart(self.pebble_service_name)
+        config = _STATIC_YAML + yaml.dump(self._generate_config(), **_YAML_OPTS)
+        config_changed = self._push_if_changed(CONFIG_PATH, config)
+        if policy_changed or config_changed or force_restart:
+            self.container.restart(self.pebble_service_name)
+        else:
+            logger.info("Config unchanged, not restarting headscale")
+
+    def _push_if_changed(self, path: Path, content: str) -> bool:
+        """Push content to path, unless the workload has it already. Returns whether it pushed."""
+        changed = self._pull_if_exists(path) != content
+        if changed:
+            self.container.push(path, content, make_dirs=True)
+        return changed
+
+    def _pull_if_exists(self, path: Path) -> Optional[str]:
+        try:
+            with self.container.pull(path) as f:
+                return f.read()
+        except ops.pebble.PathError:
+            return None
 
     def _run_cmd(self, command: List[str]):
         exc = self.container.exec(command)
@@ -211,21 +243,35 @@ class Headscale:
         hs_bin = "/usr/bin/headscale"
         return self._run_cmd([hs_bin, "--output", "yaml"] + command)
 
-    def _check_policy(self):
-        """Checks validity of hujson file by running it through hujsonfmt on the container"""
-        if self.config.policy:
-            self.container.push(POLICY_PATH, self.config.policy, make_dirs=True)
-            exc = self.container.exec(['hujsonfmt', str(POLICY_PATH)])
+    def _check_policy(self) -> bool:
+        """Validate the policy and push it to the workload, unless it's there already.
+
+        Plain JSON is accepted as is. Anything else is piped to hujsonfmt in the container over
+        stdin, so the policy file is only written once it passed.
+
+        Returns whether the policy file in the container changed.
+        """
+        if not self.config.policy:
+            return False
+        # only validated policies are ever pushed, so the one in the workload needs no check
+        if self._pull_if_exists(POLICY_PATH) == self.config.policy:
+            return False
+        # plain JSON is valid hujson, no need to exec anything for it
+        if not _is_json(self.config.policy):
+            # hujsonfmt reads stdin when given no file, so a broken policy never hits the disk
+            exc = self.container.exec(['hujsonfmt'], stdin=self.config.policy)
             try:
                 exc.wait()
             except ops.pebble.ExecError as e:
                 logger.error(f"Policy file check returned {e.exit_code}. Command: {e.command}, Output: {e.stderr}")
                 raise ValueError("Policy file incorrect")
+        self.container.push(POLICY_PATH, self.config.policy, make_dirs=True)
+        return True
 
     def create_authkey(self, tags: str, expiry: str, reusable: bool, ephemeral: bool) -> CmdResult:
         cmd = ["preauthkey", "create"]
         # Headscale wants the tags prepended with "tag:"
-        cmd += ["--tags", "tag:"+",tag:".join(tags.split(","))]
+        cmd += ["--tags", "tag:" + tags.replace(",", ",tag:")]
         cmd += ["--expiration", expiry]
         if reusable:
             cmd += ["--reusable"]
@@ -256,16 +302,25 @@ class Headscale:
         # Do backup
         backup = self.create_backup()
 
-        # stop headscale
-        self.container.stop(self.pebble_service_name)
-
-        # restore backup
-        with TemporaryDirectory() as d:
-            with TarFile.open(backup_tar_path) as t:
-                t.extractall(path=d)
-            self.container.push_path(source_path=Path(d) / "db.sqlite", dest_dir=Path(SQLITE_PATH).parent)
-            self.container.push_path(source_path=Path(d) / "noise_private.key", dest_dir=Path(NOISE_KEY).parent)
-
+        with TarFile.open(backup_tar_path) as t:
+            # check the backup before stopping, so a broken one doesn't take headscale down
+            files = []
+            for dest in (SQLITE_PATH, NOISE_KEY):
+                try:
+                    member = t.getmember(dest.name)
+                except KeyError:
+                    raise Exception(f"Backup {backup_tar_path} has no {dest.name}")
+                f = t.extractfile(member)
+                if f is None:
+                    raise Exception(f"{dest.name} in {backup_tar_path} is not a regular file")
+                files.append((dest, f, member.mode & 0o777))
+
+            # stop headscale
+            self.container.stop(self.pebble_service_name)
+
+            # restore backup, streaming each member straight into the container
+            for dest, f, mode in files:
+                self.container.push(dest, f, make_dirs=True, permissions=mode)
 
         self.container.start(self.pebble_service_name)
 
@@ -282,29 +337,45 @@ class Headscale:
             raise Exception(f"Could not create backup. {ret}")
 
         # clean up old backups
-        BACKUP_PATH.mkdir(parents=False, exist_ok=True)
-        for f in BACKUP_PATH.iterdir():
-            f.unlink()
+        shutil.rmtree(BACKUP_PATH, ignore_errors=True)
+        BACKUP_PATH.mkdir(parents=True, exist_ok=True)
 
         # Get Timestamp
         ts = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         backup_file = BACKUP_PATH / f'headscale-backup-{ts}.tar.gz'
 
-        # create tar
-        with TemporaryDirectory() as d:
-            self.container.pull_path(source_path=[remote_tmpdir / SQLITE_PATH.name, NOISE_KEY],dest_dir=d)
-            with TarFile.open(backup_file, 'w:gz') as t:
-                t.add(Path(d) / SQLITE_PATH.name, arcname=SQLITE_PATH.name)
-                t.add(Path(d) / NOISE_KEY.name, arcname=NOISE_KEY.name)
+        # create tar, streaming the files from the container straight into it
+        with TarFile.open(backup_file, 'w:gz', compresslevel=6) as t:
+            for path in (remote_tmpdir / SQLITE_PATH.name, NOISE_KEY):
+                info = self.container.list_files(path, itself=True)[0]
+                member = TarInfo(path.name)
+                member.size = info.size or 0
+                member.mode = info.permissions
+                member.mtime = int(info.last_modified.timestamp())
+                with self.container.pull(path, encoding=None) as f:
+                    t.addfile(member, f)
 
         return backup_file
 
 
+def _reject_constant(name: str):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+def _is_json(text: str) -> bool:
+    # json.loads accepts NaN and Infinity, which neither JSON nor hujson do
+    try:
+        json.loads(text, parse_constant=_reject_constant)
+    except ValueError:
+        return False
+    return True
+
+
 def dictify(out) -> Dict|List:
     """headscale doesn't always return proper yaml, so I can't trust it to be yamlable"""
     d = ""
     try:
-        d = yaml.safe_load(out)
+        d = yaml.load(out, Loader=_Loader)
         logger.debug(f"loaded yaml output: {d}")
     except yaml.YAMLError as e:
         logger.error(f"Invalid YAML: {out}.\n{e}")